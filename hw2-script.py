@@ -1,11 +1,14 @@
 #!./venv/bin/python3
-from collections import defaultdict
+import asyncio
 import time
+from gcloud.aio.storage import Storage
 from google.cloud import storage
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import hashlib
 import os
 
 testing_enabled = False  # Set to True to analyze a smaller bucket for testing purposes, False to analyze the full bucket
@@ -19,176 +22,331 @@ class LocalBlob:
     def __init__(self, full_path, base_folder):
         self.path = full_path
         self.name = os.path.relpath(full_path, base_folder).replace(os.sep, '/')
-    def download_as_text(self):
-        with open(self.path, 'r', encoding='utf-8') as f:
+    def download_as_bytes(self):
+        with open(self.path, 'rb') as f:
             return f.read()
 
 
+def build_graph(parsed_results):
+    '''
+    Assign every page and link target an integer id once, and flatten the links into two parallel edge arrays.
+    Pages get ids 0..n-1 in order, link targets outside the page set get ids from n upwards.
+    Args:
+        parsed_results (list): A list of (name, outlinks) tuples, one per page.
+    Returns:
+        tuple: (nodes, src_ids, dst_ids) where nodes is the list of page names and link k goes from src_ids[k] to dst_ids[k].
+    '''
+    nodes = [name for name, _ in parsed_results]
+    id_of = { name: i for i, name in enumerate(nodes) }
+
+    def intern(url):
+        i = id_of.get(url)
+        if i is None:
+            i = id_of[url] = len(id_of)
+        return i
+
+    dst_ids = np.fromiter((intern(link) for _, links in parsed_results for link in links), dtype=np.int32)
+    src_ids = np.repeat(np.arange(len(nodes), dtype=np.int32), [len(links) for _, links in parsed_results])
+
+    return nodes, src_ids, dst_ids
+
+
+def build_link_arrays(n, src_ids, dst_ids):
+    '''
+    Flatten the link graph into CSR arrays grouped by destination node, so the PageRank sum for node i is
+    sum(pr[indices[k]] * weights[k] for k in range(indptr[i], indptr[i + 1])).
+    Links pointing outside the node set are ignored, repeated links are kept (and so counted twice).
+    Args:
+        n (int): The number of nodes (pages), ids at or above n are links leaving the node set.
+        src_ids (np.ndarray): Source node id of each link.
+        dst_ids (np.ndarray): Destination id of each link.
+    Returns:
+        tuple: (indptr, indices, weights, dangling_nodes) where indices holds the source node ids, weights holds the precomputed
+        1 / C(source), and dangling_nodes holds the ids of nodes without outbound links.
+    '''
+    # Precompute 1 / C(Ti) once, nodes without outbound links keep a weight of 0
+    outbound_counts = np.bincount(src_ids, minlength=n)
+    inverse_counts = np.zeros(n)
+    np.divide(1.0, outbound_counts, out=inverse_counts, where=outbound_counts > 0)
+
+    internal = dst_ids < n
+    sources = src_ids[internal]
+    destinations = dst_ids[internal]
+
+    # Counting sort by destination: indptr[i]..indptr[i+1] delimits the incoming links of node i
+    indices = sources[np.argsort(destinations, kind='stable')]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(destinations, minlength=n), out=indptr[1:])
+    weights = inverse_counts[indices]
+
+    dangling_nodes = np.flatnonzero(outbound_counts == 0)
+
+    return indptr, indices, weights, dangling_nodes
+
+
+@njit(fastmath=True, cache=True)
+def page_rank_iteration(indptr, indices, weights, page_ranks, d, base):
+    '''Run one Gauss-Seidel PageRank sweep over the CSR arrays from build_link_arrays.
+    Ranks are updated in place, so nodes later in the sweep already use the new ranks of earlier ones, which converges in fewer sweeps.
+    base is the rank every node receives regardless of its incoming links. Returns the L1 change made by the sweep.'''
+    delta = 0.0
+    for i in range(page_ranks.size):
+        incoming_sum = 0.0
+        for k in range(indptr[i], indptr[i + 1]):
+            incoming_sum += page_ranks[indices[k]] * weights[k]
+        new_rank = base + d * incoming_sum
+        delta += abs(new_rank - page_ranks[i])
+        page_ranks[i] = new_rank
+    return delta
+
+
 # Formula from assignment: PR(A) = 0.15/n + 0.85 (PR(T1)/C(T1) + … +PR(Tn)/C(Tn))
 # where PR(X) is the pagerank of a page X, T1..Tn are all the pages pointing to page X, and C(X) is the number of outgoing links that page X has.
 # From this, d is 0.85, and (1-d)/n is 0.15/n
-def compute_page_rank(nodes, edges, d=0.85, tol=0.005) -> dict:
+def compute_page_rank(nodes, src_ids, dst_ids, d=0.85, tol=0.005, nstart=None) -> dict:
     '''
     Calculated using the iterative formula: PR(X) = (1-d)/n + d * (PR(T1)/C(T1) + ... + PR(Tn)/C(Tn))
     where T1...Tn are the pages linking to page X,
-    C(Ti) is the number of outbound links on page Ti
+    C(Ti) is the number of outbound links on page Ti.
+    Pages without outbound links (dangling nodes) are treated as linking to every page, so their rank is spread evenly
+    instead of being lost. The ranks then sum to 1 as long as no links point outside the node set.
     Args:
-        nodes (list): A list of node identifiers (e.g., blob names).
-        edges (dict): A dictionary where keys are node identifiers and values are lists of outbound links from the corresponding node.
+        nodes (list): A list of node identifiers (e.g., blob names), node i has id i.
+        src_ids (np.ndarray): Source node id of each link, as returned by build_graph.
+        dst_ids (np.ndarray): Destination id of each link, as returned by build_graph.
         d (float): Damping factor (set to 0.85 by default).
-        tol (float): Tolerance level for convergence (set to 0.005 by default).
+        tol (float): Tolerance on the L1 change of the PageRank vector between iterations (set to 0.005 by default).
+        nstart (array-like): Optional starting PageRank values aligned with nodes, e.g. the result of a previous run (uniform 1/n by default).
     Returns:
         dict: A dictionary mapping each node to its computed PageRank value.
     '''
     n = len(nodes)
-    
-    # Initialize PageRank values
-    page_ranks = { node: 1.0 / n for node in nodes }
+    indptr, indices, weights, dangling_nodes = build_link_arrays(n, src_ids, dst_ids)
+
+    # Initialize PageRank values, they are then updated in place.
+    # Starting from a previous result (warm start) needs fewer iterations than starting from uniform values
+    if nstart is not None:
+        page_ranks = np.array(nstart, dtype=np.float64)
+        if page_ranks.shape != (n,):
+            raise ValueError(f"nstart has {page_ranks.size} values but the graph has {n} nodes")
+    else:
+        page_ranks = np.full(n, 1.0 / n)
         
     converged = False
     iteration = 0
-    
-    # Precompute outbound link counts
-    outbound_counts = { node: len(edges[node]) for node in nodes }
-    
-    # Build incoming links mapping
-    incoming_links = defaultdict(list)
-    for node in nodes:
-        for outlink in edges[node]:
-            incoming_links[outlink].append(node)
 
     # Iterate until convergence
     while not converged:
-        # Initialize new PageRank values
-        new_page_ranks = {}
-        
-        for node in nodes:
-            # Calculate the sum of PageRank contributions from incoming links
-            incoming_sum = 0
-            for incoming_node in incoming_links[node]:
-                if outbound_counts[incoming_node] > 0:
-                    incoming_sum += page_ranks[incoming_node] / outbound_counts[incoming_node]
-            
-            # Update PageRank value using the formula
-            new_rank = (1 - d) / n + d * incoming_sum
-            new_page_ranks[node] = new_rank
+        # Update PageRank values using the formula, plus an equal share of the dangling nodes' rank.
+        # The L1 change is accumulated by the kernel itself, so no extra pass is needed to check for convergence
+        dangling_sum = page_ranks[dangling_nodes].sum()
+        base = (1 - d) / n + d * dangling_sum / n
+        delta = page_rank_iteration(indptr, indices, weights, page_ranks, d, base)
                         
         # Increment iteration count
         iteration += 1
 
-        # Calculate the average error percentage across all nodes to check for convergence
-        average_error = np.mean([abs(new_page_ranks[node] - page_ranks[node])/page_ranks[node] for node in nodes])
-        print(f"Iteration {iteration}: Average PageRank error = {average_error:.6f}")
+        print(f"Iteration {iteration}: PageRank L1 change = {delta:.6f}")
         
-        # If the average error is below the tolerance level, we consider it converged
-        if average_error < tol:
-            print(f"Iteration {iteration}: Convergence achieved with average error {average_error:.6f}")
+        # If the total change is below the tolerance level, we consider it converged
+        if delta < tol:
+            print(f"Iteration {iteration}: Convergence achieved with L1 change {delta:.6f}")
             converged = True
-        
-        page_ranks = new_page_ranks
-        
-    # Test if the sum of PageRank values is approximately 1.0 (as expected in a closed system)
-    total_rank = sum(page_ranks.values())
-    print(f"Total PageRank sum: {total_rank:.6f} (should be close to 1.0)")
-    if abs(total_rank - 1.0) > 0.01:
-        print("Warning: Total PageRank sum is not close to 1.0, which may indicate an issue with the graph structure or convergence.")
             
-    return page_ranks
+    return dict(zip(nodes, page_ranks.tolist()))
         
 
 
+def load_page_rank_cache(path, nodes):
+    '''Load PageRank values saved by save_page_rank_cache, to be used as nstart.
+    Args:
+        path (str): Path of the cache file.
+        nodes (list): The current list of node identifiers.
+    Returns:
+        np.ndarray: The cached PageRank values, or None if there is no cache or it was computed for a different node set.
+    '''
+    if not os.path.exists(path): return None
+    with np.load(path) as cache:
+        if cache['nodes'].tolist() != nodes: return None
+        return cache['page_ranks']
+
+
+def save_page_rank_cache(path, nodes, page_ranks):
+    '''Save the PageRank values computed for nodes so a later run can warm-start from them.'''
+    with open(path, 'wb') as f:
+        np.savez(f, nodes=np.array(nodes), page_ranks=np.fromiter(page_ranks.values(), dtype=np.float64, count=len(nodes)))
+
+
+def get_listing_key(source, listing):
+    '''Return a digest identifying a bucket or folder listing, given as (name, size) pairs.'''
+    digest = hashlib.sha256(source.encode())
+    for name, size in sorted(listing):
+        digest.update(f"\0{name}\0{size}".encode())
+    return digest.hexdigest()
+
+
+def load_graph_cache(path, listing_key):
+    '''Load a link graph saved by save_graph_cache.
+    Args:
+        path (str): Path of the cache file.
+        listing_key (str): Digest of the current listing, from get_listing_key.
+    Returns:
+        tuple: (nodes, src_ids, dst_ids) as returned by build_graph, or None if there is no cache or the listing changed.
+    '''
+    if not os.path.exists(path): return None
+    with np.load(path) as cache:
+        if cache['listing_key'].item() != listing_key: return None
+        return cache['nodes'].tolist(), cache['src_ids'], cache['dst_ids']
+
+
+def save_graph_cache(path, listing_key, nodes, src_ids, dst_ids):
+    '''Save the link graph for listing_key, writing to a temporary file first so an interrupted run never leaves a partial cache.'''
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, listing_key=np.array(listing_key), nodes=np.array(nodes), src_ids=src_ids, dst_ids=dst_ids)
+    os.replace(tmp_path, path)
+
+
 def get_stats(data):
     '''Calculate and return statistics for a given list of data.
     Args:
-        data (list): A list of numerical values for which statistics are to be calculated.
+        data (list or np.ndarray): The numerical values for which statistics are to be calculated.
     Returns:
         dict: A dictionary containing the average, median, maximum, minimum, and quintiles of the input data.
     '''
-    if not data: return {}
-    quintiles = np.percentile(data, [20, 40, 60, 80])
+    if len(data) == 0: return {}
+    data = np.asarray(data)
+    
+    # All order statistics from a single call, min and max are cast back so integer data still prints as integers
+    minimum, q20, q40, median, q60, q80, maximum = np.quantile(data, [0.0, 0.2, 0.4, 0.5, 0.6, 0.8, 1.0])
     
     return {
-        "Avg": np.mean(data),
-        "Median": np.median(data),
-        "Max": np.max(data),
-        "Min": np.min(data),
-        "Quintiles": [f"{x:g}" for x in quintiles]
+        "Avg": data.mean(),
+        "Median": median,
+        "Max": data.dtype.type(maximum),
+        "Min": data.dtype.type(minimum),
+        "Quintiles": [f"{x:g}" for x in (q20, q40, q60, q80)]
     }
 
 
 def process_blob_content(args):
-    """Worker function for ThreadPool."""
+    """Worker function for ProcessPool."""
     name, content = args
     try:
-        soup = BeautifulSoup(content, 'lxml')
-        outlinks = [a['href'] for a in soup.find_all('a', href=True)]
+        # Each call builds its own lexbor document, with no parser object or global lock shared between calls to reuse
+        tree = LexborHTMLParser(content)
+        folder = name.rsplit('/', 1)[0] + '/' if '/' in name else ''
+        
+        # Collect the links in a single pass over the <a> tags, resolving relative links against the page's folder so they match blob names
+        outlinks = []
+        for a in tree.tags('a'):
+            outlink = a.attributes.get('href')
+            if not outlink:
+                continue
+            outlinks.append(outlink if outlink.startswith(('http://', 'https://', '/')) else folder + outlink)
         return name, outlinks
     except Exception as e:
         return name, []
-    
-def download_helper(blob):
-    """Worker function for ThreadPool.
+
+
+def process_local_blob(blob):
+    """Worker function for ProcessPool, reads and parses a LocalBlob."""
+    return process_blob_content((blob.name, blob.download_as_bytes()))
+
+
+def process_blob_batch(batch):
+    """Worker function for ProcessPool, parses a list of (name, content) tuples in one task."""
+    return [process_blob_content(args) for args in batch]
+
+
+async def download_and_parse(bucket_name, names, parser, batch_size=200):
+    '''Download blobs concurrently on a single event loop and parse them in the process pool as each batch arrives.
     Args:
-        blob: A blob object from GCS.
+        bucket_name (str): The name of the bucket.
+        names (list): The names of the blobs to download.
+        parser (ProcessPoolExecutor): The pool used to parse the downloaded HTML.
+        batch_size (int): Number of downloads in flight at once, each finished batch is parsed while the next one downloads.
     Returns:
-        tuple: A tuple containing the blob name and its content as text, or None if the blob is not an HTML file.
-    """
-    if not blob.name.endswith('.html'): return None
-    return (blob.name, blob.download_as_text())
+        list: A list of (name, outlinks) tuples, in the same order as names.
+    '''
+    loop = asyncio.get_running_loop()
+    parse_futures = []
+    
+    async with Storage() as gcs:
+        async def fetch(name):
+            return name, await gcs.download(bucket_name, name)
+        
+        for start in range(0, len(names), batch_size):
+            batch = await asyncio.gather(*(fetch(name) for name in names[start:start + batch_size]))
+            parse_futures.append(loop.run_in_executor(parser, process_blob_batch, batch))
+    
+    return [result for results in await asyncio.gather(*parse_futures) for result in results]
 
 
-def analyze_bucket(source, is_local=False):
+def analyze_bucket(source, is_local=False, pr_cache=None, cache=None):
     '''Analyze the specified bucket or local folder and compute the statistics for in-degrees and out-degrees.
     Args:
         source (str): The name of the bucket or path to local folder.
         is_local (bool): Whether to read from local file system.
+        pr_cache (str): Optional path used to warm-start PageRank from, and save it to, for repeated runs.
+        cache (str): Optional path to cache the parsed link graph in, so repeated runs skip downloading and parsing.
     This function retrieves the blobs (objects) from the specified bucket or folder, extracts the outlinks from HTML files, and computes the in-degrees and out-degrees for each blob. It then calculates and prints the statistics for both in-degrees and out-degrees.
     '''
     start_time = time.time()
     
-    # 1. Get the data
-    blobs_to_process = []
-
+    # 1. List the HTML files
     if is_local:
         print(f"Scanning local folder: {source}")
+        local_blobs = []
         for root, _, files in os.walk(source):
             for file in files:
                 if file.endswith('.html'):
                     path = os.path.join(root, file)
-                    blob = LocalBlob(path, source)
-                    blobs_to_process.append((blob.name, blob.download_as_text()))
+                    local_blobs.append(LocalBlob(path, source))
+        listing = [(blob.name, os.path.getsize(blob.path)) for blob in local_blobs]
     else:
         print(f"Connecting to GCS Bucket: {source}")
         client = storage.Client()
         bucket = client.bucket(source)
         
-        all_blobs = list(bucket.list_blobs(max_results=10 if testing_enabled else None))
-        
-        print(f"Downloading {len(all_blobs)} files (Threaded)...")
+        # Filter to HTML files server-side and only request the fields we use, to keep listing pages small
+        html_blobs = list(bucket.list_blobs(
+            max_results=10 if testing_enabled else None,
+            match_glob='**.html',
+            fields='items(name,size),nextPageToken',
+            page_size=1000,
+        ))
+        listing = [(blob.name, blob.size) for blob in html_blobs]
+
+    # Reuse the graph from a previous run if the listing has not changed, downloading and parsing dominate the run time
+    listing_key = get_listing_key(source, listing)
+    graph = load_graph_cache(cache, listing_key) if cache else None
 
-        with ThreadPoolExecutor(max_workers=50) as downloader:
-            results = list(downloader.map(download_helper, all_blobs))
-            blobs_to_process = [r for r in results if r]
+    if graph is not None:
+        print(f"Loaded link graph from cache: {cache}")
+        nodes, src_ids, dst_ids = graph
+    else:
+        # 2. Get the data and parse HTML with multiple processes (parsing is CPU-bound, threads would contend on the GIL)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as parser:
+            if is_local:
+                # Workers read the files themselves, so the main process never holds the whole corpus and nothing is pickled but paths
+                print("Parsing HTML content...")
+                parsed_results = list(parser.map(process_local_blob, local_blobs, chunksize=16))
+            else:
+                # Downloads run on an event loop rather than one thread per request, and parsing overlaps with them
+                print(f"Downloading and parsing {len(html_blobs)} files (asyncio)...")
+                parsed_results = asyncio.run(download_and_parse(source, [blob.name for blob in html_blobs], parser))
 
-    # 2. Parse HTML with multiple threads
-    print("Parsing HTML content...")
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as parser:
-        parsed_results = list(parser.map(process_blob_content, blobs_to_process))
+        # 3. Build Graph
+        nodes, src_ids, dst_ids = build_graph(parsed_results)
+        if cache:
+            save_graph_cache(cache, listing_key, nodes, src_ids, dst_ids)
 
-    # 3. Build Graph
-    nodes = []
-    edges = {}
-    in_counts = defaultdict(int)
-    
-    for name, links in parsed_results:
-        nodes.append(name)
-        edges[name] = links
-        for link in links:
-            in_counts[link] += 1
+    n = len(nodes)
 
-    # 4. Compute Stats
-    out_degrees = [len(edges[n]) for n in nodes]
-    in_degrees = [in_counts[n] for n in nodes]
+    # 4. Compute Stats (link targets outside the page set have ids >= n, so only the first n in-degree counts are kept)
+    out_degrees = np.bincount(src_ids, minlength=n)
+    in_degrees = np.bincount(dst_ids, minlength=n)[:n]
 
     print("\n--- Statistics ---")
     outgoing_links_stats = get_stats(out_degrees)
@@ -205,7 +363,10 @@ def analyze_bucket(source, is_local=False):
     print("\n--- Page rank computation ---")
     
     # 5. Compute PageRank values
-    page_ranks = compute_page_rank(nodes, edges)
+    nstart = load_page_rank_cache(pr_cache, nodes) if pr_cache else None
+    page_ranks = compute_page_rank(nodes, src_ids, dst_ids, nstart=nstart)
+    if pr_cache:
+        save_page_rank_cache(pr_cache, nodes, page_ranks)
     
     # 6. Calculate the top 5 PageRank values
     top_5_pageranks = sorted(page_ranks.items(), key=lambda x: x[1], reverse=True)[:5]
@@ -230,7 +391,8 @@ def test_independent_correctness():
     edges = {'A': ['B'], 'B': ['C'], 'C': ['A']}
     
     # Run logic
-    pr = compute_page_rank(nodes, edges, tol=0.001)
+    nodes, src_ids, dst_ids = build_graph([(node, edges[node]) for node in nodes])
+    pr = compute_page_rank(nodes, src_ids, dst_ids, tol=0.001)
     
     # Check results
     assert abs(pr['A'] - pr['B']) < 0.01, "Symmetric graph should have equal ranks"
@@ -243,8 +405,10 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Analyze PageRank on HTML files.")
     parser.add_argument('--local', action='store_true', help="Run in local mode reading from disk.")
+    parser.add_argument('--cache', help="File to cache the parsed link graph in, reused while the listing is unchanged.")
+    parser.add_argument('--pr-cache', help="File to warm-start PageRank from, and to save the result to, across runs.")
     parser.add_argument('source', nargs='?', default=BUCKET_NAME, help="Bucket name or local folder path.")
     
     args = parser.parse_args()
     
-    analyze_bucket(args.source, is_local=args.local)
\ No newline at end of file
+    analyze_bucket(args.source, is_local=args.local, pr_cache=args.pr_cache, cache=args.cache)
\ No newline at end of file
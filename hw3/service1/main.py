@@ -1,122 +1,264 @@
 # Google cloud functions framework for defining the HTTP handler
-from flask import Request
+from flask import Request, Response
 
 import functions_framework
 
-# Google cloud libraries for Storage, Logging, and Pub/Sub
-from google.cloud import storage
-from google.cloud import logging as cloud_logging
+# Google cloud library for Pub/Sub, the Storage library is imported by get_bucket()
 from google.cloud import pubsub_v1
+import grpc
 
 # Exception handling for Google Cloud Storage operations
 import google.api_core.exceptions
 
-# json library for message formatting in Pub/Sub
-import json
+# orjson library for message formatting in Pub/Sub and logs, it serializes straight to bytes
+import orjson
+import sys
+
+# Flush pending Pub/Sub messages when the instance shuts down
+import atexit
+import threading
+
+# Constants are marked Final so type checkers (and mypyc, if the module is ever compiled) can treat them as such
+from typing import TYPE_CHECKING, Final, Optional
+
+if TYPE_CHECKING:
+    from google.api_core.retry import Retry
+    from google.cloud.pubsub_v1.publisher.futures import Future
+    from google.cloud.storage import Bucket, Client
+
+# Per-instance cache of recently served files
+from collections import OrderedDict
 
 # Bucket name
-BUCKET_NAME = "cs528-adithyav-hw2"
+BUCKET_NAME: Final[str] = "cs528-adithyav-hw2"
 
 # Configuration: Bucket name and Pub/Sub topic path
-TOPIC_PATH = "projects/main-tokenizer-486322-e1/topics/hw3-forbidden-files"
+TOPIC_PATH: Final[str] = "projects/main-tokenizer-486322-e1/topics/hw3-forbidden-files"
+
+# Set of forbidden countries, for constant-time membership checks
+FORBIDDEN_COUNTRIES: Final[frozenset[str]] = frozenset(("North Korea", "Iran", "Cuba", "Myanmar", "Iraq", "Libya", "Sudan", "Zimbabwe", "Syria"))
+
+# Constant parts of the forbidden country Pub/Sub message, only the country is serialized per request
+FORBIDDEN_EVENT_PREFIX: Final[bytes] = b'{"event":"forbidden_country","country":'
+FORBIDDEN_EVENT_SUFFIX: Final[bytes] = b',"bucket":' + orjson.dumps(BUCKET_NAME) + b'}'
+
+# Responses with a constant body, built once and returned as is instead of being encoded on every request
+FORBIDDEN_RESPONSE: Final[Response] = Response(b"Forbidden", status=400, mimetype="text/plain")
+NOT_IMPLEMENTED_RESPONSE: Final[Response] = Response(b"Not Implemented", status=501, mimetype="text/plain")
+NO_FILE_RESPONSE: Final[Response] = Response(b"Please specify the file name in the URL path", status=400, mimetype="text/plain")
+NOT_FOUND_RESPONSE: Final[Response] = Response(b"Specified file not found in bucket", status=404, mimetype="text/plain")
+SERVER_ERROR_RESPONSE: Final[Response] = Response(b"Internal Server Error", status=500, mimetype="text/plain")
+
+# Pub/Sub client, created once per instance and reused across warm invocations.
+# Messages are batched in the background, so publishing never blocks a request on a Pub/Sub round trip
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_bytes=1024 * 1024, max_latency=0.05)
+)
+atexit.register(publisher.stop)
+
+# Storage client, bucket and download retry policy, created by get_bucket(). This happens on the pre-warm thread
+# started at import, so the Storage import and client setup run during startup instead of in the first file request
+# (at the cost of every instance setting them up, including those that only reject requests)
+storage_client: Optional["Client"] = None
+bucket: Optional["Bucket"] = None
+download_retry: Optional["Retry"] = None
+storage_client_lock = threading.Lock()
+
+def get_bucket() -> "Bucket":
+    """Create the Storage client and bucket on first use and reuse them across warm invocations."""
+    global storage_client, bucket, download_retry
+    if bucket is None:
+        with storage_client_lock:
+            if bucket is None:
+                from google.cloud import storage
+                from google.cloud.storage.retry import DEFAULT_RETRY
+                from requests.adapters import HTTPAdapter
+
+                client = storage.Client()
+
+                # Keep more connections alive than the default pool of 10, so concurrent requests on an instance don't wait on new TLS handshakes.
+                # Retries stay with the storage client's own retry policy rather than being layered on in the adapter
+                client._http.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+                # Give up retrying a download after 10 seconds rather than the default 120, the caller is waiting on the response
+                download_retry = DEFAULT_RETRY.with_timeout(10.0)
+                storage_client = client
+
+                # The bucket name never changes, so one Bucket object serves every request (bucket() makes no request)
+                bucket = client.bucket(BUCKET_NAME)
+    assert bucket is not None
+    return bucket
+
+# Most recently served files, as filename -> (generation, data, content type), oldest first.
+# The cache is bounded by both entry count and total size, and files above FILE_CACHE_MAX_FILE_BYTES are never cached
+FILE_CACHE_SIZE: Final[int] = 64
+FILE_CACHE_MAX_BYTES: Final[int] = 32 * 1024 * 1024
+FILE_CACHE_MAX_FILE_BYTES: Final[int] = 1024 * 1024
+file_cache: "OrderedDict[str, tuple[int, bytes, str]]" = OrderedDict()
+file_cache_bytes = 0
+file_cache_lock = threading.Lock()
+
+def get_cached_file(filename: str) -> Optional[tuple[int, bytes, str]]:
+    """Return the cached (generation, data, content type) for a file, or None."""
+    with file_cache_lock:
+        cached = file_cache.get(filename)
+        if cached is not None:
+            file_cache.move_to_end(filename)
+        return cached
+
+def evict_file(filename: str) -> None:
+    """Remove a file from the cache, if it is cached."""
+    global file_cache_bytes
+    with file_cache_lock:
+        cached = file_cache.pop(filename, None)
+        if cached is not None:
+            file_cache_bytes -= len(cached[1])
+
+def cache_file(filename: str, generation: int, data: bytes, content_type: str) -> None:
+    """Cache a downloaded file, evicting the least recently served ones once the cache is full."""
+    global file_cache_bytes
+    if len(data) > FILE_CACHE_MAX_FILE_BYTES:
+        # Don't keep serving an older copy that was small enough to cache
+        evict_file(filename)
+        return
+    
+    with file_cache_lock:
+        previous = file_cache.pop(filename, None)
+        if previous is not None:
+            file_cache_bytes -= len(previous[1])
+        file_cache[filename] = (generation, data, content_type)
+        file_cache_bytes += len(data)
+        
+        while len(file_cache) > FILE_CACHE_SIZE or file_cache_bytes > FILE_CACHE_MAX_BYTES:
+            _, (_, evicted, _) = file_cache.popitem(last=False)
+            file_cache_bytes -= len(evicted)
+
+def log_struct(info: dict, severity: str) -> None:
+    """Write a structured log entry to stdout as one JSON line, Cloud Functions ingests these into Cloud Logging."""
+    sys.stdout.buffer.write(orjson.dumps({"severity": severity, **info}) + b"\n")
+    sys.stdout.buffer.flush()
 
-# List of forbidden countries
-FORBIDDEN_COUNTRIES = ["North Korea", "Iran", "Cuba", "Myanmar", "Iraq", "Libya", "Sudan", "Zimbabwe", "Syria"]
+def log_publish_result(future: "Future", country: str) -> None:
+    """Done callback for Pub/Sub publish futures."""
+    try:
+        future.result()
+        log_struct({"message": f"Published message to Pub/Sub topic {TOPIC_PATH} about forbidden country {country}."}, severity="INFO")
+    except Exception as e:
+        log_struct({"message": f"Failed to publish message to Pub/Sub: {e}"}, severity="ERROR")
+
+def prewarm_connections() -> None:
+    """Set up the Storage client and open the Storage and Pub/Sub connections before the first request needs them."""
+    try:
+        client = get_bucket().client
+        
+        # Any response will do, the point is fetching the access token and leaving a TLS connection in the pool
+        client._http.get(f"{client._connection.API_BASE_URL}/storage/v1/b/{BUCKET_NAME}", params={"fields": "name"}, timeout=2)
+        
+        # gRPC only connects on the first call unless asked to
+        grpc.channel_ready_future(publisher.transport.grpc_channel).result(timeout=2)
+    except Exception as e:
+        log_struct({"message": f"Failed to pre-warm connections: {e}"}, severity="WARNING")
+
+# Runs while functions_framework finishes starting up, so the first requests don't pay for the handshakes.
+# Rejected requests never wait on it, since they don't touch Storage
+threading.Thread(target=prewarm_connections, daemon=True).start()
 
 @functions_framework.http
-def get_file_from_bucket(request: Request):
+def get_file_from_bucket(request: Request) -> Response:
     """
     HTTP Cloud Function to retrieve files from GCS.
     """
     
-    # Initialize clients for Storage, Logging, and Pub/Sub
-    storage_client = storage.Client()
-    logging_client = cloud_logging.Client()
-    logger = logging_client.logger("hw3-microservice-logs") # Custom log name
-    publisher = pubsub_v1.PublisherClient()
-    
-    # 0. Check for Forbidden Countries
+    # Read the request attributes once, each access goes through a werkzeug property
+    method = request.method
+    path = request.path
     country = request.headers.get('X-country')
+
+    # 0. Check for Forbidden Countries
     if country in FORBIDDEN_COUNTRIES:
         error_msg = f"Forbidden Country: {country}"
-        print(f"ERROR: {error_msg}")
         
         # Structured Logging
-        logger.log_struct(
-            {"message": error_msg, "method": request.method, "country": country, "status": 400},
+        log_struct(
+            {"message": error_msg, "method": method, "country": country, "status": 400},
             severity="ERROR"
         )
         
         # Publish to Pub/Sub
-        message_json = json.dumps({"event": "forbidden_country", "country": country, "bucket": BUCKET_NAME})
-        message_bytes = message_json.encode('utf-8')
+        message_bytes = FORBIDDEN_EVENT_PREFIX + orjson.dumps(country) + FORBIDDEN_EVENT_SUFFIX
         try: 
+            # Don't wait for the result, the outcome is logged by the callback once the batch is sent
             future = publisher.publish(TOPIC_PATH, message_bytes)
-            future.result()
-            print(f"INFO: Published message to Pub/Sub topic {TOPIC_PATH} about forbidden country {country}.")
+            future.add_done_callback(lambda future: log_publish_result(future, country))
         except Exception as e:
-            print(f"ERROR: Failed to publish message to Pub/Sub: {e}")
+            log_struct({"message": f"Failed to publish message to Pub/Sub: {e}"}, severity="ERROR")
             
-        return "Forbidden", 400
+        return FORBIDDEN_RESPONSE
 
     # 1. Enforce HTTP Method (Only GET allowed)
-    if request.method != 'GET':
-        error_msg = f"Method {request.method} not allowed."
+    if method != 'GET':
+        error_msg = f"Method {method} not allowed."
         
         # Structured Logging
-        logger.log_struct(
-            {"message": error_msg, "method": request.method, "status": 501},
+        log_struct(
+            {"message": error_msg, "method": method, "status": 501},
             severity="ERROR"
         )
         
-        return "Not Implemented", 501
+        return NOT_IMPLEMENTED_RESPONSE
     
     # 2. Parse the file name from the URL path
-    filename = request.path.lstrip('/').split('/')[-1] # Remove leading slash and get the last part
+    filename = path.rpartition('/')[2] # Last part of the path, after the final slash
 
     if not filename:
-        return "Please specify the file name in the URL path", 400
+        return NO_FILE_RESPONSE
 
-    logger.log_struct(
-        {"message": f"Received {request.method} request for path: {request.path}", "filename": filename},
+    log_struct(
+        {"message": f"Received {method} request for path: {path}", "filename": filename},
         severity="INFO"
     )
     
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(filename)
+    blob = get_bucket().blob(filename)
+    cached = get_cached_file(filename)
 
     # 3. Try to fetch the file
     try:
-        if not blob.exists():
-            error_msg = f"File {filename} not found in bucket {bucket.name}."
-            
-            # Simple print statement
-            print(f"ERROR: {error_msg}")
-            
-            # Structured Logging
-            logger.log_struct(
-                {"message": error_msg, "file": filename, "status": 404},
-                severity="WARNING"
-            )
-            
-            return "Specified file not found in bucket", 404
-
-        # 5. Success Case: Read the file
-        contents = blob.download_as_text()
-        return contents, 200
+        # 4. Success Case: Read the file in a single request, a missing file raises NotFound below
+        # (checking blob.exists() first would cost a second round trip on every successful request).
+        # If the file is cached, GCS only sends it again when its generation has changed, otherwise NotModified is raised below
+        data = blob.download_as_bytes(
+            single_shot_download=True,
+            retry=download_retry,
+            if_generation_not_match=cached[0] if cached else None
+        )
+        content_type = blob.content_type or "text/html"
+        cache_file(filename, blob.generation, data, content_type)
+        
+        # Return the bytes as downloaded, decoding them only for Flask to encode them again would copy the file twice
+        return Response(data, status=200, mimetype=content_type, direct_passthrough=True)
 
-    # 6. Handle specific exceptions for not found and other errors
+    # 5. Handle specific exceptions for unchanged, not found and other errors
+    except google.api_core.exceptions.NotModified:
+        # The cached copy is still current (NotModified is only raised when a cached generation was sent)
+        assert cached is not None
+        _, data, content_type = cached
+        return Response(data, status=200, mimetype=content_type, direct_passthrough=True)
     except google.api_core.exceptions.NotFound:
-        logger.log_struct(
-            {"message": f"File {filename} not found in bucket {bucket.name}.", "file": filename, "status": 404},
+        error_msg = f"File {filename} not found in bucket {BUCKET_NAME}."
+
+        # Don't keep serving a file that has been deleted
+        evict_file(filename)
+        
+        # Structured Logging
+        log_struct(
+            {"message": error_msg, "file": filename, "status": 404},
             severity="WARNING"
         )
-        return "Specified file not found in bucket", 404
-    # 7. Catch-all for other exceptions (permissions, connection issues, etc.)
+        return NOT_FOUND_RESPONSE
+    # 6. Catch-all for other exceptions (permissions, connection issues, etc.)
     except Exception as e:
-        print(f"CRITICAL: {e}")
-        logger.log_struct(
+        log_struct(
             {"message": str(e), "file": filename, "status": 500},
             severity="CRITICAL"
         )
-        return "Internal Server Error", 500
\ No newline at end of file
+        return SERVER_ERROR_RESPONSE
\ No newline at end of file
@@ -1,9 +1,14 @@
-import json
-from concurrent.futures import TimeoutError
+import orjson
 from google.cloud import pubsub_v1
 from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
 
+import queue
+import random
+import signal
 import threading
+import time
+import uuid
 
 # Configuration: GCP project, Pub/Sub subscription, and GCS bucket details
 project_id = "main-tokenizer-486322-e1"
@@ -13,56 +18,208 @@ subscription_id = "hw3-forbidden-files-subscription"
 BUCKET_NAME = "cs528-adithyav-hw2"
 LOG_FILE = "forbidden-countries/log.txt"
 
+# Messages are written in batches to part objects, which are periodically composed into LOG_FILE
+PARTS_PREFIX = "forbidden-countries/parts/"
+COMPOSE_INTERVAL = 30 # seconds
+MAX_COMPOSE_SOURCES = 32 # GCS limit on source objects per compose call
+COMPOSE_ATTEMPTS = 5 # tries per batch when LOG_FILE changes at the same time
+LEASE_FILE = "forbidden-countries/compose.lease" # exists while a subscriber is composing
+LEASE_TIMEOUT = 300 # seconds, after which a lease left behind by a crashed subscriber is taken over
+BATCH_MAX_MESSAGES = 100
+BATCH_MAX_LATENCY = 1.0 # seconds
+
+# Limit on messages the subscriber holds at once
+flow_control = pubsub_v1.types.FlowControl(max_messages=200, max_bytes=10 * 1024 * 1024)
+
 subscriber = pubsub_v1.SubscriberClient()
 storage_client = storage.Client()
 bucket = storage_client.bucket(BUCKET_NAME)
 
-# Lock for local thread safety when writing to GCS
-log_lock = threading.Lock() 
-
 subscription_path = subscriber.subscription_path(project_id, subscription_id)
 
+def acquire_lease():
+    """Create the lease object so only one subscriber composes at a time. Returns its generation, or None if another subscriber holds it."""
+    lease = bucket.blob(LEASE_FILE)
+    try:
+        lease.upload_from_string(b"", if_generation_match=0)
+        return lease.generation
+    except PreconditionFailed:
+        pass
+    
+    held = bucket.get_blob(LEASE_FILE)
+    if held is None or time.time() - held.time_created.timestamp() < LEASE_TIMEOUT:
+        return None
+    
+    # The holder crashed, take the lease over unless another subscriber already did
+    try:
+        held.delete(if_generation_match=held.generation)
+        lease.upload_from_string(b"", if_generation_match=0)
+        return lease.generation
+    except (PreconditionFailed, NotFound):
+        return None
+
+def release_lease(generation):
+    try:
+        bucket.blob(LEASE_FILE).delete(if_generation_match=generation)
+    except (PreconditionFailed, NotFound):
+        # The lease expired and was taken over, it isn't ours to delete
+        pass
+
+def compose_batch(batch):
+    """Append a batch of part objects to LOG_FILE, only if the log hasn't changed since it was read."""
+    # Stored on the log, so a retry can tell that an earlier attempt already appended this batch
+    # (e.g. when the compose succeeded but its response was lost, and the client's retry got a 412)
+    batch_id = uuid.uuid4().hex
+    
+    for attempt in range(COMPOSE_ATTEMPTS):
+        log_blob = bucket.get_blob(LOG_FILE)
+        if log_blob and (log_blob.metadata or {}).get("batch_id") == batch_id:
+            return
+        
+        sources = ([log_blob] if log_blob else []) + batch
+        destination = bucket.blob(LOG_FILE)
+        destination.metadata = {"batch_id": batch_id}
+        try:
+            # Generation 0 means the log must not exist yet
+            destination.compose(sources, if_generation_match=log_blob.generation if log_blob else 0)
+            return
+        except (PreconditionFailed, NotFound):
+            if attempt == COMPOSE_ATTEMPTS - 1:
+                raise
+            
+            # The log changed since it was read, or a part was already composed and deleted by a subscriber
+            # whose lease had expired. Leave out the parts that are gone, then read the log again after a jittered backoff
+            batch = [part for part in batch if part.exists()]
+            if not batch:
+                return
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+def compose_log():
+    """Append all part objects to LOG_FILE in the order they were written, then delete them."""
+    # Only the lease holder composes, so no two subscribers append the same parts
+    generation = acquire_lease()
+    if generation is None:
+        return
+    
+    try:
+        # Part names start with a timestamp, so sorting by name keeps the log in order
+        parts = sorted(bucket.list_blobs(prefix=PARTS_PREFIX), key=lambda part: part.name)
+        
+        # The existing log takes one of the source slots in every compose call
+        for start in range(0, len(parts), MAX_COMPOSE_SOURCES - 1):
+            batch = parts[start:start + MAX_COMPOSE_SOURCES - 1]
+            compose_batch(batch)
+            
+            # Parts deleted already are fine, they were composed by a subscriber whose lease had expired
+            bucket.delete_blobs(batch, on_error=lambda part: None)
+            print(f"Composed {len(batch)} log parts into gs://{BUCKET_NAME}/{LOG_FILE}")
+    finally:
+        release_lease(generation)
+
+def compose_loop():
+    while True:
+        time.sleep(COMPOSE_INTERVAL)
+        try:
+            compose_log()
+        except Exception as gcs_error:
+            print(f"Error composing log in GCS: {gcs_error}")
+
+# Messages waiting to be written, as (message, log line) tuples. None tells the flusher to stop
+log_queue = queue.SimpleQueue()
+
+# Set once shutdown has started, new messages are then nacked so another subscriber picks them up.
+# The lock keeps a callback from queueing a message behind the flusher's stop sentinel
+draining = False
+draining_lock = threading.Lock()
+
+def write_batch(batch):
+    """Write a batch of log lines to a single part object, then ack their messages."""
+    if not batch:
+        return
+    
+    try:
+        part_name = f"{PARTS_PREFIX}{time.time_ns()}-{uuid.uuid4().hex}.jsonl"
+        bucket.blob(part_name).upload_from_string(b"".join(line for _, line in batch), content_type="text/plain")
+        print(f"Wrote {len(batch)} log entries to gs://{BUCKET_NAME}/{part_name}")
+    except Exception as gcs_error:
+        # Let Pub/Sub redeliver the messages instead of losing their entries
+        print(f"Error writing to GCS: {gcs_error}")
+        for message, _ in batch:
+            message.nack()
+        return
+    
+    for message, _ in batch:
+        message.ack()
+
+def flusher():
+    """Write queued log lines in batches of up to BATCH_MAX_MESSAGES, or whatever arrived within BATCH_MAX_LATENCY of the first."""
+    while True:
+        item = log_queue.get()
+        batch = []
+        deadline = time.monotonic() + BATCH_MAX_LATENCY
+        while item is not None:
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= BATCH_MAX_MESSAGES or remaining <= 0:
+                break
+            try:
+                item = log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        
+        write_batch(batch)
+        if item is None:
+            return
+
 def callback(message):
     print(f"Received message: {message}")
     
     try:
         # Decode the data
         if message.data:
-            data = json.loads(message.data.decode("utf-8"))
+            data = orjson.loads(message.data)
             print(f"Data: {data}")
             
-            # Append to storage bucket with concurrency handling
-            with log_lock:
-                try:
-                    blob = bucket.get_blob(LOG_FILE)
-                    existing_content = ""
-                    if blob:
-                        existing_content = blob.download_as_text()
-                    else:
-                        blob = bucket.blob(LOG_FILE)
-                    
-                    new_content = existing_content + json.dumps(data) + "\n"
-                    
-                    blob.upload_from_string(new_content)
-                    print(f"Appended log to gs://{BUCKET_NAME}/{LOG_FILE}")
-                
-                except Exception as gcs_error:
-                     print(f"Error writing to GCS: {gcs_error}")
-                
-        message.ack()
+            # The GCS write happens on the flusher thread, the message is acked once its batch has been written
+            line = orjson.dumps(data) + b"\n"
+            with draining_lock:
+                if draining:
+                    message.nack()
+                else:
+                    log_queue.put((message, line))
+        else:
+            message.ack()
     except Exception as e:
         print(f"Error processing message: {e}")
 
-streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+threading.Thread(target=compose_loop, daemon=True).start()
+flusher_thread = threading.Thread(target=flusher, daemon=True)
+flusher_thread.start()
+
+streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control)
 print(f"Listening for messages on {subscription_path}..\n")
 
-# Wrap subscriber in a 'with' block to automatically call close() when done.
-with subscriber:
-    try:
-        # When `timeout` is not set, result() will block indefinitely,
-        # unless an exception is encountered first.
-        streaming_pull_future.result()
-    except TimeoutError:
-        # Shut down the subscriber gracefully on timeout.
-        streaming_pull_future.cancel()
-        streaming_pull_future.result()
+# Wake the main thread on SIGTERM/SIGINT, or if the stream stops on its own because of an error
+shutdown_event = threading.Event()
+
+def request_shutdown(signum, frame):
+    print(f"Received signal {signum}, shutting down..")
+    shutdown_event.set()
+
+signal.signal(signal.SIGTERM, request_shutdown)
+signal.signal(signal.SIGINT, request_shutdown)
+streaming_pull_future.add_done_callback(lambda future: shutdown_event.set())
+
+try:
+    shutdown_event.wait()
+    
+    # Write out the messages already queued while the stream is still open, so their acks are sent instead of them being redelivered
+    with draining_lock:
+        draining = True
+        log_queue.put(None)
+    flusher_thread.join()
+    
+    streaming_pull_future.cancel()
+    streaming_pull_future.result()
+finally:
+    subscriber.close()